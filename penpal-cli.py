@@ -1,25 +1,48 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 from penpal.env import ROOT_FOLDER
-from penpal.render import (
-    parse_document_text, DocumentRenderer,
-)
+from penpal.document_parser import parse_document_sections
+from penpal.render import DocumentRenderer
 
 
 INPUT = ROOT_FOLDER / "content" / "index.md"
 OUTPUT = ROOT_FOLDER / "generated-site" / "content" / "_index.md"
 
 
+def _process_one(paths: tuple[Path, Path]) -> None:
+    input_file, output_file = paths
+    # Render each section as soon as it's parsed, rather than holding the whole document's sections first
+    output_text = DocumentRenderer(parse_document_sections(input_file.read_text())).render()
+    # Write from the worker, so the parsed sections never need to be pickled back to the parent
+    output_file.write_text(output_text)
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('input_file')
-    parser.add_argument('output_file')
+    parser.add_argument('files', nargs='+', metavar='input_file output_file', help='One or more input/output pairs')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Documents to render in parallel. Only safe when at most one document uses $!generate!$',
+    )
     args = parser.parse_args()
-    sections = parse_document_text(Path(args.input_file).read_text())
-    renderer = DocumentRenderer(sections)
-    output_text = renderer.render()
-    Path(args.output_file).write_text(output_text)
+    if len(args.files) % 2:
+        parser.error('Expected input and output files in pairs')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    file_pairs = [(Path(i), Path(o)) for i, o in zip(args.files[::2], args.files[1::2])]
+
+    # Documents can be rendered in separate processes to sidestep the GIL.
+    # This is opt-in: $!generate!$ snapshots are only numbered within each document, so documents that generate
+    # programs write to the same directories under GENERATED_PROGRAMS_DIR and would race with each other.
+    if len(file_pairs) == 1 or args.jobs == 1:
+        for file_pair in file_pairs:
+            _process_one(file_pair)
+        return
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        # Consume the results so that any exception raised by a worker is re-raised here
+        list(executor.map(_process_one, file_pairs))
 
 
 if __name__ == '__main__':
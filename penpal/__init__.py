@@ -1,26 +1,23 @@
-from pathlib import Path
+from importlib import import_module
 
-from penpal.env import CHAPTER_1_ROOT, ROOT_FOLDER
-from penpal.render import (
-    parse_document_text, DocumentRenderer,
-)
-from penpal.shell_utils import run_and_check, run_and_capture_output
-from penpal.snippet import SnippetRepository
+# Submodules are imported on first access (PEP 562), so `import penpal` stays cheap for callers that only need
+# part of the package, such as the parser.
+_LAZY_ATTRIBUTES = {
+    "CHAPTER_1_ROOT": "penpal.env",
+    "ROOT_FOLDER": "penpal.env",
+    "parse_document_text": "penpal.document_parser",
+    "DocumentRenderer": "penpal.render",
+    "run_and_check": "penpal.shell_utils",
+    "run_and_capture_output": "penpal.shell_utils",
+    "SnippetRepository": "penpal.snippet",
+}
 
+__all__ = list(_LAZY_ATTRIBUTES)
 
-INPUT = ROOT_FOLDER / "content" / "index.md"
-OUTPUT = ROOT_FOLDER / "generated-site" / "content" / "_index.md"
 
-INPUT = Path("/Users/philliptennen/Documents/axle-blog/content/blog/literate_programming/index-in.md")
-OUTPUT = Path("/Users/philliptennen/Documents/axle-blog/content/blog/literate_programming/index.md")
+def __getattr__(name: str):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(import_module(module_name), name)
 
-
-def main():
-    sections = parse_document_text(INPUT.read_text())
-    renderer = DocumentRenderer(sections)
-    output_text = renderer.render()
-    OUTPUT.write_text(output_text)
-
-
-if __name__ == "__main__":
-    main()
@@ -1,39 +1,52 @@
 from dataclasses import dataclass
+from typing import Iterator
+from weakref import WeakValueDictionary
 
 from penpal.lexer import TokenType
-from penpal.markdown_parser import Command, MarkdownParser, DefineSnippet, EmbedSnippet, EmbedText, ShowCommand
+from penpal.markdown_parser import (
+    Command, MarkdownParser, DefineSnippet, EmbedSnippet, EmbedText, ShowCommand, share_short_text,
+)
 from penpal.snippet import SnippetHeader, SnippetLanguage
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, weakref_slot=True)
 class TextSection:
     text: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class CommandSection:
     command: Command
 
 
 DocumentSection = TextSection | CommandSection
 
+# Gaps between commands (often just newlines) are shared in the same way as the text runs within snippets
+_SHARED_TEXT_SECTIONS: WeakValueDictionary[str, TextSection] = WeakValueDictionary()
 
-def parse_document_text(text: str) -> list[DocumentSection]:
-    output_sections = []
+
+def text_section(text: str) -> TextSection:
+    return share_short_text(_SHARED_TEXT_SECTIONS, text, TextSection)
+
+
+def parse_document_sections(text: str) -> Iterator[DocumentSection]:
+    """Yields each section as soon as it's parsed, so a renderer can consume the document while it's being parsed."""
     parser = MarkdownParser(text)
+    lexer = parser.lexer
     while True:
-        tokens_before_command = parser.read_tokens_until_command_begins()
+        text_before_command = parser.read_str_until_command_begins()
         # We may immediately start with a command
-        if len(tokens_before_command):
-            text_before_command = "".join(t.value for t in tokens_before_command)
-            output_sections.append(TextSection(text_before_command))
+        if len(text_before_command):
+            yield text_section(text_before_command)
 
-        if parser.lexer.peek().type == TokenType.EOF:
+        if lexer.peek().type == TokenType.EOF:
             break
 
-        output_sections.append(CommandSection(parser.parse_command()))
+        yield CommandSection(parser.parse_command())
 
-    return output_sections
+
+def parse_document_text(text: str) -> list[DocumentSection]:
+    return list(parse_document_sections(text))
 
 
 class TestDocumentParser:
@@ -141,3 +154,24 @@ snip3
             ),
             CommandSection(command=ShowCommand(snippet_name="snip3")),
         ]
+
+    def test_whitespace_sections_are_shared(self):
+        sections = parse_document_text("\n$!show a\n\n!$\n\n$!show b\n\n!$\nText\n")
+        assert sections[0] == TextSection("\n")
+        assert sections[0] is sections[2]
+        assert sections[4] == TextSection("Text\n")
+        # Only shared while something still uses it
+        sections = parse_document_text("$!show a\n\n!$\n \n\t\n")
+        assert sections[1] is text_section(" \n\t\n")
+        del sections
+        assert " \n\t\n" not in _SHARED_TEXT_SECTIONS
+
+    def test_sections_are_streamed(self):
+        import pytest
+
+        sections = parse_document_sections("Intro\n$!show a\n\n!$\n$!unknown!$")
+        assert next(sections) == TextSection("Intro\n")
+        assert next(sections) == CommandSection(ShowCommand(snippet_name="a", url=""))
+        # The bad command is only reached once the consumer asks for it
+        with pytest.raises(NotImplementedError):
+            next(sections)
@@ -1,45 +1,61 @@
-from dataclasses import dataclass
-from enum import Enum, auto
-from typing import Self
+import re
+from array import array
+from enum import Enum, IntEnum
+from functools import cache
+from typing import NamedTuple, Self
 
 Cursor = int
 
 
-class TokenType(Enum):
-    EOF = auto()
-    Word = auto()
-    Comma = auto()
-    LeftBrace = auto()
-    RightBrace = auto()
-    LeftAngle = auto()
-    RightAngle = auto()
-    Space = auto()
-    Newline = auto()
-    Hash = auto()
-    Dollar = auto()
-    Bang = auto()
+class TokenType(IntEnum):
+    # Explicit, contiguous values: they're stored as the bytes of Lexer.types and used as table indexes
+    EOF = 0
+    Word = 1
+    Comma = 2
+    LeftBrace = 3
+    RightBrace = 4
+    LeftAngle = 5
+    RightAngle = 6
+    Space = 7
+    Newline = 8
+    Hash = 9
+    Dollar = 10
+    Bang = 11
+
+    # Keep messages reading TokenType.Word, rather than the bare number IntEnum would print
+    __str__ = Enum.__str__
 
     @classmethod
     def try_from_str(cls, s: str) -> Self | None:
-        mapping = {
-            ",": TokenType.Comma,
-            "{": TokenType.LeftBrace,
-            "}": TokenType.RightBrace,
-            "<": TokenType.LeftAngle,
-            ">": TokenType.RightAngle,
-            " ": TokenType.Space,
-            "\n": TokenType.Newline,
-            "#": TokenType.Hash,
-            "$": TokenType.Dollar,
-            "!": TokenType.Bang,
-        }
-        if s in mapping:
-            return mapping[s]
-        return None
-
-
-@dataclass
-class Token:
+        if len(s) != 1:
+            return None
+        codepoint = ord(s)
+        return _CHAR_TO_TOKEN_TYPE[codepoint] if codepoint < 128 else None
+
+
+_DELIMITER_TOKEN_TYPES = {
+    ",": TokenType.Comma,
+    "{": TokenType.LeftBrace,
+    "}": TokenType.RightBrace,
+    "<": TokenType.LeftAngle,
+    ">": TokenType.RightAngle,
+    " ": TokenType.Space,
+    "\n": TokenType.Newline,
+    "#": TokenType.Hash,
+    "$": TokenType.Dollar,
+    "!": TokenType.Bang,
+}
+# Indexed by ASCII codepoint
+_CHAR_TO_TOKEN_TYPE = tuple(_DELIMITER_TOKEN_TYPES.get(chr(codepoint)) for codepoint in range(128))
+# Indexed by the type codes stored in Lexer.types
+_TOKEN_TYPES_BY_CODE = tuple(TokenType)
+
+# Each one-character delimiter is its own token, and everything between delimiters is a word
+_DELIMITER_CLASS = "".join(re.escape(ch) for ch in _DELIMITER_TOKEN_TYPES)
+_TOKEN_RE = re.compile(f"([{_DELIMITER_CLASS}])|([^{_DELIMITER_CLASS}]+)")
+
+
+class Token(NamedTuple):
     type: TokenType
     value: str
     start_pos: int
@@ -55,55 +71,92 @@ class Token:
         )
 
 
+TokenTypeSeq = tuple[TokenType, ...]
+
+
+@cache
+def type_codes(token_types: TokenTypeSeq) -> bytes:
+    """Encodes a sequence of token types in the same form as Lexer.types."""
+    return bytes(token_types)
+
+
 class Lexer:
+    text: str
+    types: bytes
+    starts: "array[int]"
+    ends: "array[int]"
+    cursor: Cursor
+
     def __init__(self, text: str) -> None:
         self.text = text
+        # Tokenize the whole input up-front, so peeking and rewinding are just moves of an index.
+        # Tokens are stored as parallel arrays: one type code per token, and the token's bounds within the text.
+        # Token objects are only built when a caller asks for one.
+        types = bytearray()
+        self.starts = array("q")
+        self.ends = array("q")
+        for match in _TOKEN_RE.finditer(text):
+            delimiter = match.group(1)
+            token_type = _DELIMITER_TOKEN_TYPES[delimiter] if delimiter else TokenType.Word
+            types.append(token_type)
+            self.starts.append(match.start())
+            self.ends.append(match.end())
+        self.types = bytes(types)
+        self._eof = Token.eof(len(text))
+        # Index of the next token to be consumed
         self.cursor = 0
 
-    def _consume_token(self) -> Token:
-        if self.cursor >= len(self.text):
-            return Token.eof(len(self.text))
-
-        chars = []
-        start_pos = self.cursor
-        cursor = self.cursor
-        while True:
-            ch = self.text[cursor]
-            # Is it a one-character delimiter?
-            if token_type := TokenType.try_from_str(ch):
-                # If we're at the start of the word, we can return here
-                if not len(chars):
-                    return Token(type=token_type, value=ch, start_pos=start_pos, end_pos=cursor + 1)
-                else:
-                    # Finish the current word
-                    break
-
-            cursor += 1
-            chars.append(ch)
-
-            # Did we reach EOF?
-            if cursor >= len(self.text):
-                break
-
-        return Token(type=TokenType.Word, value="".join(chars), start_pos=start_pos, end_pos=cursor)
+    def token_at(self, idx: int) -> Token:
+        if idx >= len(self.types):
+            return self._eof
+        start_pos = self.starts[idx]
+        end_pos = self.ends[idx]
+        return Token(
+            type=_TOKEN_TYPES_BY_CODE[self.types[idx]],
+            value=self.text[start_pos:end_pos],
+            start_pos=start_pos,
+            end_pos=end_pos,
+        )
+
+    def tokens_between(self, start_idx: int, end_idx: int) -> list[Token]:
+        return [self.token_at(i) for i in range(start_idx, end_idx)]
+
+    def text_between(self, start_idx: int, end_idx: int) -> str:
+        """Returns the source text spanned by the tokens in [start_idx, end_idx)."""
+        if start_idx >= end_idx:
+            return ""
+        return self.text[self.starts[start_idx] : self.ends[end_idx - 1]]
 
     def next(self) -> Token:
-        token = self._consume_token()
-        self.cursor = token.end_pos
+        token = self.token_at(self.cursor)
+        if self.cursor < len(self.types):
+            self.cursor += 1
         return token
 
     def peek(self) -> Token:
-        return self.peek_n(1)[0]
+        return self.token_at(self.cursor)
 
     def peek_n(self, n: int) -> list[Token]:
-        start_cursor = self.cursor
-        tokens = [self.next() for _ in range(n)]
-        self.cursor = start_cursor
-        return tokens
+        return [self.token_at(self.cursor + i) for i in range(n)]
+
+    def peek2_is(self, t0: TokenType, t1: TokenType) -> bool:
+        types = self.types
+        i = self.cursor
+        return i + 1 < len(types) and types[i] == t0 and types[i + 1] == t1
 
-    def peek_next_token_types_match(self, next_types: list[TokenType]) -> bool:
-        peek_tokens = self.peek_n(len(next_types))
-        return [p.type for p in peek_tokens] == next_types
+    def peek3_is(self, t0: TokenType, t1: TokenType, t2: TokenType) -> bool:
+        types = self.types
+        i = self.cursor
+        return i + 2 < len(types) and types[i] == t0 and types[i + 1] == t1 and types[i + 2] == t2
+
+    def peek_next_token_types_match(self, next_types: TokenTypeSeq) -> bool:
+        # The command delimiters are two or three tokens long, so check those directly without encoding the sequence
+        match len(next_types):
+            case 2:
+                return self.peek2_is(*next_types)
+            case 3:
+                return self.peek3_is(*next_types)
+        return self.types.startswith(type_codes(tuple(next_types)), self.cursor)
 
 
 class TestLexer:
@@ -139,3 +192,34 @@ class TestLexer:
         assert lexer.next() == Token(TokenType.EOF, "", 22, 22)
         assert lexer.next() == Token(TokenType.EOF, "", 22, 22)
         assert lexer.next() == Token(TokenType.EOF, "", 22, 22)
+
+    def test_command_delimiters(self):
+        lexer = Lexer("$!show x!$")
+        assert [t.type for t in lexer.peek_n(7)] == [
+            TokenType.Dollar,
+            TokenType.Bang,
+            TokenType.Word,
+            TokenType.Space,
+            TokenType.Word,
+            TokenType.Bang,
+            TokenType.Dollar,
+        ]
+        assert lexer.peek_n(9)[-2:] == [Token(TokenType.EOF, "", 10, 10), Token(TokenType.EOF, "", 10, 10)]
+
+    def test_peek_is(self):
+        lexer = Lexer("$!x")
+        assert lexer.peek2_is(TokenType.Dollar, TokenType.Bang)
+        assert not lexer.peek2_is(TokenType.Bang, TokenType.Dollar)
+        assert lexer.peek3_is(TokenType.Dollar, TokenType.Bang, TokenType.Word)
+        lexer.next()
+        assert lexer.peek_next_token_types_match((TokenType.Bang, TokenType.Word))
+        # Never matches past the end of the input
+        assert not lexer.peek3_is(TokenType.Bang, TokenType.Word, TokenType.Word)
+        assert not lexer.peek_next_token_types_match((TokenType.Bang, TokenType.Word, TokenType.Word, TokenType.Word))
+
+    def test_try_from_str(self):
+        assert TokenType.try_from_str("$") == TokenType.Dollar
+        assert TokenType.try_from_str("\n") == TokenType.Newline
+        assert TokenType.try_from_str("a") is None
+        assert TokenType.try_from_str("é") is None
+        assert TokenType.try_from_str("$!") is None
@@ -1,19 +1,28 @@
+import logging
+import re
+import sys
 from dataclasses import dataclass
-from enum import Enum, auto
-from typing import Self
+from functools import lru_cache
+from typing import Callable, TypeVar
+from weakref import WeakValueDictionary
 
 import yaml
 
-from penpal.lexer import TokenType, Lexer, Token
+from penpal.lexer import TokenType, Lexer, Token, TokenTypeSeq, type_codes
 from penpal.snippet import SnippetHeader, SnippetLanguage
 
+logger = logging.getLogger(__name__)
 
-@dataclass
+# Use libyaml's loader when PyYAML was built with it
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+@dataclass(slots=True, frozen=True)
 class EmbedSnippet:
     snippet_name: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, weakref_slot=True)
 class EmbedText:
     text: str
 
@@ -21,49 +30,56 @@ class EmbedText:
 SnippetProductionRule = EmbedSnippet | EmbedText
 
 
-class CommandType(Enum):
-    UpdateSnippet = auto()
-    ShowSnippet = auto()
-    ExecuteProgram = auto()
-    DefineSnippet = auto()
-    GenerateProgram = auto()
+# Short runs of text (such as whitespace, or closing braces) repeat throughout a document, so the frozen instances that
+# hold them are shared. They're only shared while in use, so the tables never outgrow the parsed documents.
+_SHORT_TEXT_LEN = 64
+
+SharedText = TypeVar("SharedText")
+
+
+def share_short_text(
+    shared: WeakValueDictionary[str, SharedText], text: str, make: Callable[[str], SharedText]
+) -> SharedText:
+    if len(text) > _SHORT_TEXT_LEN:
+        return make(text)
+    instance = shared.get(text)
+    if instance is None:
+        instance = shared[text] = make(text)
+    return instance
+
+
+_SHARED_EMBED_TEXTS: WeakValueDictionary[str, EmbedText] = WeakValueDictionary()
+
 
-    @classmethod
-    def from_str(cls, s: str) -> Self:
-        return {
-            "update": CommandType.UpdateSnippet,
-            "show": CommandType.ShowSnippet,
-            "execute": CommandType.ExecuteProgram,
-            "define": CommandType.DefineSnippet,
-            "generate": CommandType.GenerateProgram,
-        }[s]
+def embed_text(text: str) -> EmbedText:
+    return share_short_text(_SHARED_EMBED_TEXTS, text, EmbedText)
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class UpdateCommand:
     snippet_name: str
     update_data: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ShowCommand:
     snippet_name: str
     url: str | None = None
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ExecuteProgram:
     pass
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class DefineSnippet:
     header: SnippetHeader
     snippet_name: str
     content: list[SnippetProductionRule]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class GenerateProgram:
     pass
 
@@ -77,6 +93,55 @@ Command = (
 )
 
 
+# Snippet headers are almost always a few `key: value` lines, so those are parsed by hand rather than through YAML.
+# Anything that YAML might read differently (quoting, numbers, nulls, nesting, comments...) falls back to the real
+# loader.
+_SIMPLE_HEADER_LINE_RE = re.compile(r"([A-Za-z][\w-]*): ([A-Za-z_/][\w./-]*|\[([A-Za-z_/][\w./-]*(?:, [A-Za-z_/][\w./-]*)*)?\])")
+# Words YAML 1.1 resolves to booleans or null rather than strings
+_YAML_SPECIAL_WORDS = {
+    word
+    for base in ("y", "yes", "n", "no", "on", "off", "true", "false", "null")
+    for word in (base, base.capitalize(), base.upper())
+}
+
+
+def _parse_simple_header_value(value: str) -> str | bool:
+    if value == "true":
+        return True
+    if value == "false":
+        return False
+    if value in _YAML_SPECIAL_WORDS:
+        raise ValueError(value)
+    return value
+
+
+def parse_snippet_header_fields(header_str: str) -> dict:
+    fields = {}
+    try:
+        for line in header_str.splitlines():
+            match = _SIMPLE_HEADER_LINE_RE.fullmatch(line)
+            if match is None:
+                raise ValueError(line)
+            key, value, list_items = match.groups()
+            if key in _YAML_SPECIAL_WORDS:
+                raise ValueError(key)
+            if value.startswith("["):
+                fields[key] = [_parse_simple_header_value(item) for item in list_items.split(", ")] if list_items else []
+            else:
+                fields[key] = _parse_simple_header_value(value)
+    except ValueError:
+        return yaml.load(header_str, Loader=_YAML_LOADER)
+    # An empty header is null in YAML
+    return fields or None
+
+
+# Most definitions repeat one of a few headers (e.g. just "lang: rust"), so each distinct header is only validated once.
+# The resulting headers are shared between definitions, which is safe because SnippetHeader is frozen.
+@lru_cache(maxsize=1024)
+def parse_snippet_header(header_str: str) -> SnippetHeader:
+    return SnippetHeader.parse_obj(parse_snippet_header_fields(header_str))
+
+
 class MarkdownParser:
     #BEGIN_COMMAND_SEQ = [TokenType.LeftBrace, TokenType.LeftBrace]
     #END_COMMAND_SEQ = [TokenType.RightBrace, TokenType.RightBrace]
@@ -86,68 +151,81 @@ class MarkdownParser:
     #END_COMMAND_SEQ = [TokenType.RightAngle, TokenType.RightAngle]
 
     # Chose to be unlikely to conflict
-    BEGIN_COMMAND_SEQ = [TokenType.Dollar, TokenType.Bang]
-    END_COMMAND_SEQ = [TokenType.Bang, TokenType.Dollar]
-    END_MULTI_LINE_COMMAND_SEQ = [TokenType.Newline, *END_COMMAND_SEQ]
+    BEGIN_COMMAND_SEQ = (TokenType.Dollar, TokenType.Bang)
+    END_COMMAND_SEQ = (TokenType.Bang, TokenType.Dollar)
+    END_MULTI_LINE_COMMAND_SEQ = (TokenType.Newline, *END_COMMAND_SEQ)
+
+    # Built once here, rather than on every call in the hot parsing paths
+    SNIPPET_BREAK_SEQS = (BEGIN_COMMAND_SEQ, END_COMMAND_SEQ, END_MULTI_LINE_COMMAND_SEQ)
+    # Most characters to least characters
+    COMMAND_CLOSE_SEQS = (
+        (TokenType.Newline, *END_COMMAND_SEQ, TokenType.Newline),
+        (TokenType.Newline, *END_COMMAND_SEQ),
+        (*END_COMMAND_SEQ, TokenType.Newline),
+        END_COMMAND_SEQ,
+    )
+    SEPARATE_HEAD_FROM_CONTENT_SEQ = (TokenType.Hash, TokenType.Hash, TokenType.Hash)
+    TERMINATE_SHORTHAND_DEFINITION_SEQ = (TokenType.Newline, TokenType.RightBrace, TokenType.RightBrace)
 
     def __init__(self, text: str) -> None:
-        self.text = self
+        self.text = text
         self.lexer = Lexer(text)
 
     def read_tokens_until(self, break_on_type: TokenType) -> list[Token]:
-        tokens = []
-        while True:
-            next_tok = self.lexer.peek()
-            if next_tok.type in [break_on_type, TokenType.EOF]:
-                break
-            tokens.append(self.lexer.next())
-        return tokens
+        return self.read_tokens_until_sequence((break_on_type,))
 
-    def read_tokens_until_any_sequence(self, break_on_any_of_sequences: list[list[TokenType]]) -> list[Token]:
+    def read_span_until_any_sequence(self, break_on_any_of_sequences: tuple[TokenTypeSeq, ...]) -> tuple[int, int]:
+        """Consumes tokens until one of the break sequences is next, and returns the index range of the consumed tokens."""
         for break_on_sequence in break_on_any_of_sequences:
             if len(break_on_sequence) < 1:
                 raise ValueError("Need at least one type to break on")
 
-        tokens = []
-        while True:
-            next_tok = self.lexer.peek()
-            if next_tok.type == TokenType.EOF:
-                return tokens
-            tokens.append(self.lexer.next())
-
-            for break_on_sequence in break_on_any_of_sequences:
-                # Look back at the last few tokens and see if it matches the break sequence
-                last_few_tokens = tokens[-len(break_on_sequence) :]
-                if [t.type for t in last_few_tokens] == break_on_sequence:
-                    # Strip the break tokens
-                    tokens = tokens[: -len(break_on_sequence)]
-                    # Rewind the cursor
-                    self.lexer.cursor = last_few_tokens[0].start_pos
-                    return tokens
-
-    def read_tokens_until_sequence(self, break_on_sequence: list[TokenType]) -> list[Token]:
-        return self.read_tokens_until_any_sequence([break_on_sequence])
+        break_sequences = [type_codes(tuple(s)) for s in break_on_any_of_sequences]
+        types = self.lexer.types
+        start = self.lexer.cursor
+        # Search the type codes with bytes.find rather than stepping through tokens in Python.
+        # The sequence that finishes first wins, and ties go to whichever sequence was listed first.
+        best_start = len(types)
+        best_end = None
+        for break_on_sequence in break_sequences:
+            sequence_start = types.find(break_on_sequence, start)
+            if sequence_start == -1:
+                continue
+            sequence_end = sequence_start + len(break_on_sequence)
+            if best_end is None or sequence_end < best_end:
+                best_start = sequence_start
+                best_end = sequence_end
+
+        # Leave the cursor on the first token of the break sequence, and don't include the break tokens
+        self.lexer.cursor = best_start
+        return start, best_start
+
+    def read_tokens_until_any_sequence(self, break_on_any_of_sequences: tuple[TokenTypeSeq, ...]) -> list[Token]:
+        return self.lexer.tokens_between(*self.read_span_until_any_sequence(break_on_any_of_sequences))
+
+    def read_tokens_until_sequence(self, break_on_sequence: TokenTypeSeq) -> list[Token]:
+        return self.read_tokens_until_any_sequence((break_on_sequence,))
 
     def read_tokens_until_command_begins(self) -> list[Token]:
         return self.read_tokens_until_sequence(self.BEGIN_COMMAND_SEQ)
 
+    def read_str_until_command_begins(self) -> str:
+        return self.read_str_until_seq(self.BEGIN_COMMAND_SEQ)
+
     def parse_snippet_production_rules(self) -> list[SnippetProductionRule]:
         out = []
         while True:
             # Handle nested commands
-            tokens_before_nested_command = self.read_tokens_until_any_sequence(
-                [self.BEGIN_COMMAND_SEQ, [*self.END_COMMAND_SEQ], self.END_MULTI_LINE_COMMAND_SEQ]
-            )
+            text_before_nested_command = self.read_str_until_any_seq(self.SNIPPET_BREAK_SEQS)
             # We might immediately have an embed-snippet rule, so it's not a guarantee that there will be text before
             # the first command.
-            if len(tokens_before_nested_command):
-                text_before_nested_command = "".join(t.value for t in tokens_before_nested_command)
-                out.append(EmbedText(text_before_nested_command))
+            if len(text_before_nested_command):
+                out.append(embed_text(text_before_nested_command))
 
             # What's next?
             if self.lexer.peek_next_token_types_match(self.BEGIN_COMMAND_SEQ):
                 self.match_command_open()
-                embedded_snippet_name = self.match_word()
+                embedded_snippet_name = self.match_snippet_name()
                 self.match_command_close()
                 out.append(EmbedSnippet(embedded_snippet_name))
             else:
@@ -156,16 +234,14 @@ class MarkdownParser:
 
         return out
 
-    def read_str_until_seq(self, delimiter_seq: list[TokenType]) -> str:
-        tokens = self.read_tokens_until_sequence(delimiter_seq)
-        return "".join(t.value for t in tokens)
+    def read_str_until_seq(self, delimiter_seq: TokenTypeSeq) -> str:
+        return self.read_str_until_any_seq((delimiter_seq,))
 
-    def read_str_until_any_seq(self, delimiter_seqs: list[list[TokenType]]) -> str:
-        tokens = self.read_tokens_until_any_sequence(delimiter_seqs)
-        return "".join(t.value for t in tokens)
+    def read_str_until_any_seq(self, delimiter_seqs: tuple[TokenTypeSeq, ...]) -> str:
+        return self.lexer.text_between(*self.read_span_until_any_sequence(delimiter_seqs))
 
     def read_str_until(self, delimiter: TokenType) -> str:
-        return self.read_str_until_seq([delimiter])
+        return self.read_str_until_seq((delimiter,))
 
     def expect(self, token_type: TokenType) -> Token:
         next_tok = self.lexer.next()
@@ -173,21 +249,14 @@ class MarkdownParser:
             raise RuntimeError(f"Expected {token_type}, but found {next_tok}")
         return next_tok
 
-    def expect_seq(self, token_types: list[TokenType]) -> list[Token]:
+    def expect_seq(self, token_types: TokenTypeSeq) -> list[Token]:
         return [self.expect(tok_type) for tok_type in token_types]
 
     def match_command_open(self) -> list[Token]:
         return self.expect_seq(self.BEGIN_COMMAND_SEQ)
 
     def match_command_close(self) -> list[Token]:
-        # Most characters to least characters
-        delimiters = [
-            [TokenType.Newline, *self.END_COMMAND_SEQ, TokenType.Newline],
-            [TokenType.Newline, *self.END_COMMAND_SEQ],
-            [*self.END_COMMAND_SEQ, TokenType.Newline],
-            [*self.END_COMMAND_SEQ]
-        ]
-        for delimiter in delimiters:
+        for delimiter in self.COMMAND_CLOSE_SEQS:
             if self.lexer.peek_next_token_types_match(delimiter):
                 return self.expect_seq(delimiter)
         raise ValueError("Failed to match a command close!")
@@ -195,28 +264,32 @@ class MarkdownParser:
     def match_word(self) -> str:
         return self.expect(TokenType.Word).value
 
+    def match_snippet_name(self) -> str:
+        # Snippet names are interned, so the renderer's lookups by name can match on identity
+        return sys.intern(self.match_word())
+
     def parse_command__update(self) -> UpdateCommand:
         self.expect(TokenType.Space)
-        snippet_name = self.expect(TokenType.Word)
+        snippet_name = self.match_snippet_name()
         self.expect(TokenType.Newline)
-        update_data = self.read_tokens_until_sequence(self.END_MULTI_LINE_COMMAND_SEQ)
+        update_data = self.read_str_until_seq(self.END_MULTI_LINE_COMMAND_SEQ)
         self.match_command_close()
-        print(f"Parsing update, snippet name {snippet_name} {update_data}")
+        logger.debug("Parsing update, snippet name %s %s", snippet_name, update_data)
 
         return UpdateCommand(
-            snippet_name=snippet_name.value,
-            update_data="".join([t.value for t in update_data]) + '\n',
+            snippet_name=snippet_name,
+            update_data=update_data + '\n',
         )
 
     def parse_command__show(self) -> ShowCommand:
         self.expect(TokenType.Space)
-        snippet_name = self.expect(TokenType.Word)
+        snippet_name = self.match_snippet_name()
         self.expect(TokenType.Newline)
         url = self.read_str_until(TokenType.Newline)
         self.match_command_close()
-        print(f"snippet name {snippet_name} url {url}")
+        logger.debug("snippet name %s url %s", snippet_name, url)
 
-        return ShowCommand(snippet_name=snippet_name.value, url=url)
+        return ShowCommand(snippet_name=snippet_name, url=url)
 
     def parse_command__execute(self) -> ExecuteProgram:
         self.match_command_close()
@@ -224,12 +297,11 @@ class MarkdownParser:
 
     def parse_command__define(self) -> DefineSnippet:
         self.expect(TokenType.Space)
-        snippet_name = self.read_str_until(TokenType.Newline)
-        separate_head_from_content = [TokenType.Hash, TokenType.Hash, TokenType.Hash]
-        terminate_shorthand_definition = [TokenType.Newline, TokenType.RightBrace, TokenType.RightBrace]
-        header_str = self.read_str_until_any_seq([separate_head_from_content, terminate_shorthand_definition])
-        header_dict = yaml.load(header_str, Loader=yaml.SafeLoader)
-        header = SnippetHeader.parse_obj(header_dict)
+        snippet_name = sys.intern(self.read_str_until(TokenType.Newline))
+        separate_head_from_content = self.SEPARATE_HEAD_FROM_CONTENT_SEQ
+        terminate_shorthand_definition = self.TERMINATE_SHORTHAND_DEFINITION_SEQ
+        header_str = self.read_str_until_any_seq((separate_head_from_content, terminate_shorthand_definition))
+        header = parse_snippet_header(header_str)
         if self.lexer.peek_next_token_types_match(terminate_shorthand_definition):
             self.expect_seq([*terminate_shorthand_definition, TokenType.Newline])
             # Shorthand empty definition
@@ -252,24 +324,22 @@ class MarkdownParser:
         return GenerateProgram()
 
     def parse_command(self) -> Command:
-        # Expect two braces
         self.match_command_open()
         # Command name
-        command_name = self.expect(TokenType.Word)
-        command_type = CommandType.from_str(command_name.value)
-        print(f"Found command name {command_name.value} of type {command_type}")
-        if command_type == CommandType.UpdateSnippet:
-            return self.parse_command__update()
-        elif command_type == CommandType.ShowSnippet:
-            return self.parse_command__show()
-        elif command_type == CommandType.ExecuteProgram:
-            return self.parse_command__execute()
-        elif command_type == CommandType.DefineSnippet:
-            return self.parse_command__define()
-        elif command_type == CommandType.GenerateProgram:
-            return self.parse_command__generate()
-        else:
-            raise NotImplementedError(command_type)
+        command_name = self.expect(TokenType.Word).value
+        if command_name not in _COMMAND_DISPATCH:
+            raise NotImplementedError(command_name)
+        return _COMMAND_DISPATCH[command_name](self)
+
+
+# Maps each command name to the parser method that handles the rest of the command
+_COMMAND_DISPATCH: dict[str, Callable[[MarkdownParser], Command]] = {
+    "update": MarkdownParser.parse_command__update,
+    "show": MarkdownParser.parse_command__show,
+    "execute": MarkdownParser.parse_command__execute,
+    "define": MarkdownParser.parse_command__define,
+    "generate": MarkdownParser.parse_command__generate,
+}
 
 
 class TestMarkdownParser:
@@ -424,3 +494,91 @@ edition = "2021"
                 EmbedSnippet(snippet_name='cargo_toml_dependencies')
             ]
         )
+
+    def test_read_tokens_until(self):
+        parser = MarkdownParser("a, b {c}")
+        assert [t.value for t in parser.read_tokens_until(TokenType.LeftBrace)] == ["a", ",", " ", "b", " "]
+        assert parser.lexer.peek().type == TokenType.LeftBrace
+        # Runs to the end of the input when the type never appears
+        assert [t.value for t in parser.read_tokens_until(TokenType.Hash)] == ["{", "c", "}"]
+        assert parser.lexer.peek().type == TokenType.EOF
+
+    def test_read_until_any_sequence_prefers_earliest_end(self):
+        # `$!` finishes before `!$`, even though `!$` starts first
+        parser = MarkdownParser("ab !$!x")
+        seqs = ((TokenType.Bang, TokenType.Dollar, TokenType.Word), (TokenType.Dollar, TokenType.Bang))
+        assert parser.read_str_until_any_seq(seqs) == "ab !"
+        assert parser.lexer.peek().type == TokenType.Dollar
+        # Sequences finishing on the same token are tried in the order they're listed
+        seqs = (MarkdownParser.END_COMMAND_SEQ, MarkdownParser.END_MULTI_LINE_COMMAND_SEQ)
+        assert MarkdownParser("ab\n!$\ncd").read_str_until_any_seq(seqs) == "ab\n"
+        assert MarkdownParser("ab\n!$\ncd").read_str_until_any_seq(seqs[::-1]) == "ab"
+        # Reads to the end when nothing matches
+        assert MarkdownParser("ab cd").read_str_until_any_seq(seqs) == "ab cd"
+
+    def test_parse_snippet_header_fields(self):
+        for header_str in [
+            "file: src/main.rs\nlang: rust\n",
+            "lang: rust\nexecutable: true\ndepends-on: [cargo_toml, main_rs]\n",
+            "lang: toml\ndepends-on: []\nexecutable: false",
+            # These all need the YAML loader
+            "lang: rust\nexecutable: yes\n",
+            "lang: rust\nfile: 'src/main.rs'\n",
+            "lang: rust\nfile: null\n",
+            "lang: rust\nversion: 1.0\n",
+            "lang: rust # a comment\n",
+            "depends-on:\n  - a\n  - b\n",
+            "",
+        ]:
+            assert parse_snippet_header_fields(header_str) == yaml.load(header_str, Loader=yaml.SafeLoader)
+
+    def test_snippet_names_are_interned(self):
+        parser = MarkdownParser(
+            "$!define outer\nlang: rust\n###\n$!inner!$\n!$\n"
+            "$!define inner\nlang: rust\n###\ninner\n!$\n"
+            "$!show inner\n\n!$\n"
+            "$!update inner\nupdated\n!$\n"
+        )
+        commands = []
+        for _ in range(4):
+            parser.read_str_until_command_begins()
+            commands.append(parser.parse_command())
+        outer, inner, show, update = commands
+        names = [outer.content[0].snippet_name, inner.snippet_name, show.snippet_name, update.snippet_name]
+        assert names == ["inner"] * 4
+        assert all(name is names[0] for name in names)
+
+    def test_short_embed_texts_are_shared(self):
+        parser = MarkdownParser("$!a!$\n}\n$!b!$\n}\n$!c!$\n}\nfn long_enough_to_be_left_alone() -> usize { 0 }\n!$")
+        rules = parser.parse_snippet_production_rules()
+        assert [rule.text for rule in rules if isinstance(rule, EmbedText)] == [
+            "}\n",
+            "}\n",
+            "}\nfn long_enough_to_be_left_alone() -> usize { 0 }\n",
+        ]
+        assert rules[1] is rules[3]
+        # Only shared while something still uses it
+        del rules, parser
+        assert "}\n" not in _SHARED_EMBED_TEXTS
+
+    def test_identical_headers_are_shared(self):
+        import pytest
+        from pydantic import ValidationError
+
+        parser = MarkdownParser(
+            "$!define a\nlang: rust\n###\na\n!$\n"
+            "$!define b\nlang: rust\n###\nb\n!$\n"
+            "$!define c\nlang: rust\nfile: src/main.rs\n###\nc\n!$\n"
+        )
+        commands = []
+        for _ in range(3):
+            parser.read_str_until_command_begins()
+            commands.append(parser.parse_command())
+        a, b, c = commands
+        assert a.header is b.header
+        assert a.header == SnippetHeader(lang=SnippetLanguage.RUST)
+        assert c.header == SnippetHeader(lang=SnippetLanguage.RUST, file="src/main.rs")
+        # A shared header can't be modified through one of the definitions that uses it
+        with pytest.raises(ValidationError):
+            a.header.file = "src/main.rs"
+        assert b.header.file is None
@@ -4,9 +4,9 @@ from pathlib import Path
 from typing import Optional, Self
 
 import yaml
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
-from penpal import ROOT_FOLDER, CHAPTER_1_ROOT
+from penpal.env import ROOT_FOLDER, CHAPTER_1_ROOT
 
 
 class SnippetLanguage(Enum):
@@ -16,11 +16,14 @@ class SnippetLanguage(Enum):
 
 
 class SnippetHeader(BaseModel):
+    # Parsed headers are cached and shared between snippets, so they're immutable
+    model_config = ConfigDict(frozen=True)
+
     lang: SnippetLanguage
     # Should this be a 'complete' program that can be run and tested?
     is_executable: bool = Field(default=False, alias="executable")
     # This snippet 'depends' on another snippet to form a complete program
-    dependencies: list[str] = Field(default=[], alias="depends-on")
+    dependencies: tuple[str, ...] = Field(default=(), alias="depends-on")
     # The path within the crate that this snippet should be rendered to
     file: Optional[str] = Field(default=None)
 